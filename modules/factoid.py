@@ -57,13 +57,60 @@ message, which include the channel explicitely. See their corresponding
 
 """
 from willie.module import *
+from willie.tools import stderr
 
 import re
 import os
 import json
+import copy
+import threading
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    # Without sortedcontainers, listnames just sorts on every call
+    SortedList = None
+
+try:
+    import orjson
+except ImportError:
+    # Fall back to the (slower) stdlib json module for exports
+    orjson = None
+
+# Splits arguments on whitespace, see addcmd
+whitespace_re = re.compile(r"\s+")
+# Verbs supported by addcmd
+verbs = frozenset(('is', 'are'))
 
 def setup(bot):
-    pass
+    # Keep the cached data and pending modifications in bot.memory,
+    # so they survive reloading this module. Otherwise, modifications
+    # not written out yet would be lost, since the shutdown hook and
+    # flush_pending are not called on reload.
+    if not 'factoid' in bot.memory:
+        bot.memory['factoid'] = {}
+    state = bot.memory['factoid']
+    for name in ('facts_cache', 'aliases_cache', 'rev_aliases_cache',
+                 'sorted_names_cache', 'dirty', 'lock'):
+        if not name in state:
+            state[name] = getattr(get_channel_data, name)
+        setattr(get_channel_data, name, state[name])
+
+def shutdown(bot):
+    # Make sure no modifications are lost
+    flush_pending(bot)
+
+@interval(5)
+def flush_pending(bot):
+    """Periodically write out the data of all modified channels, so a
+       burst of modifications results in a single write."""
+    for channel in list(get_channel_data.dirty):
+        try:
+            flush_channel_data(bot, channel)
+        except Exception as exc:
+            # Keep going, so one failing channel does not prevent
+            # writing the others. It is retried on the next run.
+            stderr("Failed to write factoid data for {}: {}".format(channel, exc))
 
 class FactError(Exception):
     """Exception when manipulating factoid, contains human-readable error message."""
@@ -97,93 +144,187 @@ def get_channel_data(bot, channel):
             get_cached('factoids_aliases', get_channel_data.aliases_cache))
 get_channel_data.facts_cache = {}
 get_channel_data.aliases_cache = {}
+get_channel_data.rev_aliases_cache = {}
+get_channel_data.sorted_names_cache = {}
+get_channel_data.dirty = {}
+# Protects all of the above against concurrent modification, since
+# willie runs commands and interval jobs in separate threads
+get_channel_data.lock = threading.Lock()
+
+def get_reverse_aliases(bot, channel):
+    """Retrieve the reverse alias index for the given channel. This is
+       not stored, but built from the aliases on first use.
+
+       Returns a dict mapping lowercase fact names to a set of lowercase
+       alias names that point to them. Facts without aliases might not
+       be present in the dict."""
+    cache = get_channel_data.rev_aliases_cache
+    if not channel in cache:
+        facts, aliases = get_channel_data(bot, channel)
+        rev = {}
+        for (alias, target) in aliases.items():
+            rev.setdefault(target, set()).add(alias)
+        cache[channel] = rev
+    return cache[channel]
+
+def get_sorted_names(bot, channel):
+    """Retrieve sorted lists of fact names (with original casing) and
+       lowercase alias names for the given channel. These are built on
+       first use and then kept up to date when facts or aliases are
+       added or removed.
+
+       Returns a tuple of two SortedList objects, or None when
+       sortedcontainers is not available."""
+    if SortedList is None:
+        return None
+    cache = get_channel_data.sorted_names_cache
+    if not channel in cache:
+        facts, aliases = get_channel_data(bot, channel)
+        cache[channel] = (SortedList(name for (name, verb, values) in facts.values()),
+                          SortedList(aliases.keys()))
+    return cache[channel]
+
+def mark_channel_data(channel):
+    """Mark the fact and alias data for the given channel as modified,
+       so the next flush_pending() run writes it out."""
+    get_channel_data.dirty[channel] = True
+
+def flush_channel_data(bot, channel):
+    """Write out the fact and alias data for the given channel, if it
+       was modified since it was last written. If writing fails, the
+       data stays marked as modified."""
+    # Take a snapshot and clear the flag while holding the lock, then
+    # write outside of it, so commands are not blocked on the write and
+    # modifications made while writing are not lost
+    with get_channel_data.lock:
+        if not get_channel_data.dirty.pop(channel, False):
+            return
+        facts, aliases = copy.deepcopy(get_channel_data(bot, channel))
+    try:
+        set_channel_data(bot, channel, facts, aliases)
+    except Exception:
+        mark_channel_data(channel)
+        raise
 
 def set_channel_data(bot, channel, facts, aliases):
     """Update fact and/or alias data. Should be passed the two dicts
     returned by get_channel_data(), possibly modified (but not replaced
-    by a new dict)."""
+    by a new dict), or a copy of them."""
     bot.db.set_channel_value(channel, 'factoids_facts', facts)
     bot.db.set_channel_value(channel, 'factoids_aliases', aliases)
 
     if bot.config.has_option('factoid', 'export_dir'):
         obj = {'facts': facts, 'aliases': aliases}
         fname = os.path.join(bot.config.factoid.export_dir, channel + '.json')
-        with open(fname, 'w') as out:
-            json.dump(obj, out, indent=4, sort_keys=True)
+        tmp = fname + '.tmp'
+        # Serialize up front and write in one go, streaming would
+        # issue a separate write for every token.
+        data = dump_json(obj)
+        # Write to a temporary file and rename it into place, so anyone
+        # downloading the export never sees a partially written file.
+        with open(tmp, 'wb') as out:
+            out.write(data)
+        os.rename(tmp, fname)
+
+def dump_json(obj):
+    """Serialize obj to pretty-printed JSON with sorted keys. Returns
+       UTF-8 encoded bytes. Uses orjson when available, which is a lot
+       faster for big exports. The stdlib fallback is configured to
+       produce the exact same output."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, indent=2, sort_keys=True, ensure_ascii=False,
+                      separators=(',', ': ')).encode('utf-8')
 
 def get_value(bot, channel, key):
     """Retrieve a single value. Returns (key, verb, facts), where key is
     the key with the original casing, and facts is a list of facts."""
     facts, aliases = get_channel_data(bot, channel)
-
-    # Resolve alias
-    try:
-        key = aliases[key.lower()]
-    except KeyError:
-        # No alias defined, that's ok
-        pass
-
-    return facts.get(key.lower(), None)
+    # Aliases map to lowercase fact names, so they can be used to index
+    # facts directly.
+    lkey = key.lower()
+    return facts.get(aliases.get(lkey, lkey))
 
 def add_facts(bot, channel, key, verb, add, also):
     """
     Add one or more facts.
     """
-    facts, aliases = get_channel_data(bot, channel)
-    add = [value.strip() for value in add]
-    try:
-        key = aliases[key.lower()]
-    except KeyError:
-        # No alias defined, that's ok
-        pass
-
-    try:
-        (key, verb, values) = facts[key.lower()]
-        if not also:
-            raise FactError("{} is already defined. Say \"{} is also ...\" to add an additional meaning".format(key, key))
-        values.extend(add)
-    except KeyError:
-        values = add
+    with get_channel_data.lock:
+        facts, aliases = get_channel_data(bot, channel)
+        add = [value.strip() for value in add]
+        lkey = key.lower()
+
+        # Resolve alias, if any. The original key casing is taken from the
+        # fact below, since an alias always points to an existing fact.
+        lkey = aliases.get(lkey, lkey)
+
+        existing = facts.get(lkey)
+        if existing is not None:
+            (key, verb, values) = existing
+            if not also:
+                raise FactError("{} is already defined. Say \"{} is also ...\" to add an additional meaning".format(key, key))
+            values.extend(add)
+        else:
+            values = add
+            names = get_channel_data.sorted_names_cache.get(channel)
+            if names is not None:
+                names[0].add(key)
 
-    facts[key.lower()] = (key, verb, values)
-    set_channel_data(bot, channel, facts, aliases)
+        facts[lkey] = (key, verb, values)
+        mark_channel_data(channel)
 
 def set_alias(bot, channel, key, value):
     """Add an alias."""
-    facts, aliases = get_channel_data(bot, channel)
-
-    if key.lower() in aliases:
-        raise FactError('{} is already an alias, use the delete/forget command to remove the alias first.'.format(key))
-
-    if key.lower() in facts:
-        raise FactError('{} already has facts, use the delete/forget command to remove the alias first.'.format(key))
-
-    # Resolve value as an alias, so we never store
-    # alias-to-alias, but only alias-to-fact.
-    try:
-        value = aliases[value.lower()]
-    except KeyError:
-        # No alias defined, that's ok
-        pass
-
-    if not value.lower() in facts:
-        raise FactError("{} is not defined yet. Define it first before you can add an alias.".format(value))
-    aliases[key.lower()] = value.lower()
-    set_channel_data(bot, channel, facts, aliases)
+    with get_channel_data.lock:
+        facts, aliases = get_channel_data(bot, channel)
+        lkey = key.lower()
+        lvalue = value.lower()
+
+        if lkey in aliases:
+            raise FactError('{} is already an alias, use the delete/forget command to remove the alias first.'.format(key))
+
+        if lkey in facts:
+            raise FactError('{} already has facts, use the delete/forget command to remove the alias first.'.format(key))
+
+        # Resolve value as an alias, so we never store
+        # alias-to-alias, but only alias-to-fact.
+        lvalue = aliases.get(lvalue, lvalue)
+
+        if not lvalue in facts:
+            raise FactError("{} is not defined yet. Define it first before you can add an alias.".format(value))
+        aliases[lkey] = lvalue
+        get_reverse_aliases(bot, channel).setdefault(lvalue, set()).add(lkey)
+        names = get_channel_data.sorted_names_cache.get(channel)
+        if names is not None:
+            names[1].add(lkey)
+        mark_channel_data(channel)
 
 def delete_value(bot, channel, key):
     """Delete a fact or alias."""
-    facts, aliases = get_channel_data(bot, channel)
-    if key.lower() in facts:
-        del facts[key.lower()]
-        # Delete all aliases that point to this fact, too
-        for k in [k for (k, v) in aliases.items() if v == key.lower()]:
-            del aliases[k]
-    elif key.lower() in aliases:
-        del aliases[key.lower()]
-    else:
-        raise FactError('I don\'t know about {}'.format(key))
-    set_channel_data(bot, channel, facts, aliases)
+    with get_channel_data.lock:
+        facts, aliases = get_channel_data(bot, channel)
+        rev = get_reverse_aliases(bot, channel)
+        names = get_channel_data.sorted_names_cache.get(channel)
+        lkey = key.lower()
+        if lkey in facts:
+            (name, verb, values) = facts.pop(lkey)
+            if names is not None:
+                names[0].remove(name)
+            # Delete all aliases that point to this fact, too
+            for k in rev.pop(lkey, ()):
+                del aliases[k]
+                if names is not None:
+                    names[1].remove(k)
+        elif lkey in aliases:
+            target = aliases.pop(lkey)
+            rev[target].discard(lkey)
+            if not rev[target]:
+                del rev[target]
+            if names is not None:
+                names[1].remove(lkey)
+        else:
+            raise FactError('I don\'t know about {}'.format(key))
+        mark_channel_data(channel)
 
 @commands('(.+?) (is|are) (also )?(.+)')
 @require_chanmsg()
@@ -291,12 +432,8 @@ def do_get(bot, channel, target, key, error):
 
     (key, verb, values) = value
 
-    formatted = ''
-    for value in values:
-        if formatted:
-            formatted += ' and also {}'.format(value)
-        else:
-            formatted += value
+    # Skip empty values, which can be stored by e.g. "foo is  and also bar"
+    formatted = ' and also '.join(v for v in values if v)
 
     max_messages = 3
     bot.say('{}: {} {} {}'.format(target, key, verb, formatted), max_messages)
@@ -346,7 +483,7 @@ def addcmd(bot, trigger):
     # Since our last argument can contain spaces, we split the arguments
     # here manually.
 
-    args = re.split("\s+", trigger.group(2), 3)
+    args = whitespace_re.split(trigger.group(2), 3)
     if len(args) < 4:
         bot.reply("Need at least 4 arguments")
         return
@@ -357,7 +494,7 @@ def addcmd(bot, trigger):
         bot.reply("Invalid channel specified: {}. Valid channels are {}".format(channel, ', '.join(bot.channels)))
         return
 
-    if not verb in ['is', 'are']:
+    if not verb in verbs:
         bot.reply("Only 'is' and 'are' are supported as verbs, not {}".format(verb))
         return
 
@@ -443,11 +580,18 @@ def listnames(bot, trigger):
         bot.reply("Invalid channel specified: {}. Valid channels are {}".format(channel, ', '.join(bot.channels)))
         return
 
-    facts, aliases = get_channel_data(bot, channel)
+    with get_channel_data.lock:
+        names = get_sorted_names(bot, channel)
+        if names is not None:
+            factnames = list(names[0])
+            aliasnames = list(names[1])
+        else:
+            facts, aliases = get_channel_data(bot, channel)
+            factnames = sorted(name for (name, verb, values) in facts.values())
+            aliasnames = sorted(aliases.keys())
     # Use msg instead of reply, since that supports splitting
-    factnames = [name for (name, verb, values) in facts.values()]
-    bot.msg(trigger.nick, 'Facts: {}'.format(', '.join(sorted(factnames))), max_messages=10)
-    bot.msg(trigger.nick, 'Aliases: {}'.format(', '.join(sorted(aliases.keys()))), max_messages=10)
+    bot.msg(trigger.nick, 'Facts: {}'.format(', '.join(factnames)), max_messages=10)
+    bot.msg(trigger.nick, 'Aliases: {}'.format(', '.join(aliasnames)), max_messages=10)
 
 @commands('factoid export')
 @require_privmsg()
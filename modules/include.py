@@ -40,7 +40,8 @@ def setup(bot):
 
 def include(bot, filename):
     try:
-        with open(filename) as f:
+        # Use a big buffer, the parser reads line by line
+        with open(filename, 'r', 1 << 16) as f:
             bot.config.parser.readfp(f, filename)
     except Exception as exc:
         stderr("Failed to read included config file {}: {}".format(filename, exc))